@@ -16,13 +16,13 @@ Credits:        Garth by matin - for authenticating and uploading with
 """
 import os
 import json
+import functools
 import subprocess
 import sys
 import logging
 import re
-from typing import List
-import tkinter as tk
-from tkinter import filedialog
+import shutil
+from dataclasses import dataclass
 from datetime import datetime
 from getpass import getpass
 from pathlib import Path
@@ -89,6 +89,7 @@ def ensure_packages():
     """Ensure all required packages are installed and tracked."""
     required_packages = ["garth", "fit_tool"]
     installed_packages = load_installed_packages()
+    changed = False
 
     for package in required_packages:
         if package in installed_packages:
@@ -99,46 +100,56 @@ def ensure_packages():
             logger.info(f"Package {package} not found."
                         "Attempting to install...")
             install_package(package)
+            importlib.invalidate_caches()
+            if not importlib.util.find_spec(package):
+                logger.error(f"Failed to find {package} even "
+                             "after installation.")
+                continue
 
-        try:
-            __import__(package)
-            logger.info(f"Successfully imported {package}.")
-            installed_packages.add(package)
-        except ModuleNotFoundError:
-            logger.error(f"Failed to import {package} even "
-                         "after installation.")
-
-    save_installed_packages(installed_packages)
-
-
-ensure_packages()
-
-
-# Imports
-try:
-    import garth
-    from garth.exc import GarthException, GarthHTTPError
-    from fit_tool.fit_file import FitFile
-    from fit_tool.fit_file_builder import FitFileBuilder
-    from fit_tool.profile.messages.file_creator_message import (
-        FileCreatorMessage
-    )
-    from fit_tool.profile.messages.record_message import (
-        RecordMessage,
-        RecordTemperatureField
-    )
-    from fit_tool.profile.messages.session_message import SessionMessage
-    from fit_tool.profile.messages.lap_message import LapMessage
-except ImportError as e:
-    logger.error(f"Error importing modules: {e}")
+        installed_packages.add(package)
+        changed = True
+
+    if changed:
+        save_installed_packages(installed_packages)
+
+
+def import_dependencies():
+    """
+    Import garth and fit_tool into the module namespace.
+
+    Called from main() after ensure_packages() so that missing packages
+    can be installed before they are imported.
+
+    Exits:
+        Exits with status 1 if a package cannot be imported.
+    """
+    global garth, GarthException, GarthHTTPError
+    global FitFile, FitFileBuilder
+    global RecordMessage, RecordTemperatureField, SessionMessage, LapMessage
+    try:
+        import garth
+        from garth.exc import GarthException, GarthHTTPError
+        from fit_tool.fit_file import FitFile
+        from fit_tool.fit_file_builder import FitFileBuilder
+        from fit_tool.profile.messages.record_message import (
+            RecordMessage,
+            RecordTemperatureField
+        )
+        from fit_tool.profile.messages.session_message import SessionMessage
+        from fit_tool.profile.messages.lap_message import LapMessage
+    except ImportError as e:
+        logger.error(f"Error importing modules: {e}")
+        sys.exit(1)
 
 
 TOKENS_PATH = SCRIPT_DIR / '.garth'
 FILE_DIALOG_TITLE = "MyWhoosh2Garmin"
 # Fix for https://github.com/JayQueue/MyWhoosh2Garmin/issues/2
 MYWHOOSH_PREFIX_WINDOWS = "MyWhooshTechnologyService." 
+VERSION_DIGITS = re.compile(r"\d+")
 
 
+@functools.lru_cache(maxsize=1)
 def get_fitfile_location() -> Path:
     """
     Get the location of the FIT file directory based on the operating system.
@@ -173,21 +184,21 @@ def get_fitfile_location() -> Path:
     elif os.name == "nt":  # Windows
         try:
             base_path = Path.home() / "AppData" / "Local" / "Packages"
-            for directory in base_path.iterdir():
-                if (directory.is_dir() and 
-                        directory.name.startswith(MYWHOOSH_PREFIX_WINDOWS)):
-                    target_path = (
-                            directory
-                            / "LocalCache"
-                            / "Local"
-                            / "MyWhoosh"
-                            / "Content"
-                            / "Data"
-                )
-            if target_path.is_dir():
-                return target_path
-            else:
-                raise FileNotFoundError(f"No valid MyWhoosh directory found in {target_path}")
+            with os.scandir(base_path) as entries:
+                for entry in entries:
+                    if (entry.name.startswith(MYWHOOSH_PREFIX_WINDOWS) and
+                            entry.is_dir(follow_symlinks=False)):
+                        target_path = (
+                                Path(entry.path)
+                                / "LocalCache"
+                                / "Local"
+                                / "MyWhoosh"
+                                / "Content"
+                                / "Data"
+                        )
+                        if target_path.is_dir():
+                            return target_path
+            raise FileNotFoundError(f"No valid MyWhoosh directory found in {base_path}")
         except FileNotFoundError as e:
                 logger.error(str(e))
         except PermissionError as e:
@@ -222,6 +233,9 @@ def get_backup_path(json_file=json_file_path) -> Path:
             logger.error("Invalid backup path stored in JSON.")
             sys.exit(1)
     else:
+        import tkinter as tk
+        from tkinter import filedialog
+
         root = tk.Tk()
         root.withdraw() 
         backup_path = filedialog.askdirectory(title=f"Select {FILE_DIALOG_TITLE} "
@@ -234,9 +248,26 @@ def get_backup_path(json_file=json_file_path) -> Path:
         logger.info(f"Backup path saved to {json_file}.")
     return Path(backup_path)
 
-FITFILE_LOCATION = get_fitfile_location()
 BACKUP_FITFILE_LOCATION = get_backup_path()
 
+def save_garth_tokens():
+    """
+    Save the Garth session tokens without ever leaving half-written files.
+
+    The tokens are saved to a temporary directory first and each file is
+    then moved into TOKENS_PATH with an atomic os.replace().
+
+    Returns:
+        None
+    """
+    tmp_path = TOKENS_PATH.with_name(f"{TOKENS_PATH.name}.tmp")
+    garth.save(tmp_path)
+    TOKENS_PATH.mkdir(exist_ok=True)
+    for token_file in tmp_path.iterdir():
+        os.replace(token_file, TOKENS_PATH / token_file.name)
+    tmp_path.rmdir()
+
+
 def get_credentials_for_garmin():
     """
     Prompt the user for Garmin credentials and authenticate using Garth.
@@ -252,7 +283,7 @@ def get_credentials_for_garmin():
     logger.info("Authenticating...")
     try:
         garth.login(username, password)
-        garth.save(TOKENS_PATH)
+        save_garth_tokens()
         print()
         logger.info("Successfully authenticated!")
     except GarthHTTPError:
@@ -288,45 +319,89 @@ def authenticate_to_garmin():
         sys.exit(1)
 
 
-def calculate_avg(values: iter) -> int:
+@dataclass
+class SessionTotals:
+    """Running totals of the records seen since the last session message."""
+
+    cadence: int = 0
+    power: int = 0
+    heart_rate: int = 0
+    count: int = 0
+
+    def average(self, total: int) -> float:
+        """Return the average of a running total, or 0 without records."""
+        return total / self.count if self.count else 0
+
+    def reset(self) -> None:
+        """Start counting a new session."""
+        self.cadence = self.power = self.heart_rate = self.count = 0
+
+
+def process_record_message(message: object, totals: SessionTotals) -> None:
     """
-    Calculate the average of a list of values, returning 0 if the list is empty.
+    Remove the temperature field from a record message and add its
+    cadence, power and heart rate to the running totals.
 
     Args:
-        values (List[float]): The list of values to average.
+        message (RecordMessage): The record message to process.
+        totals (SessionTotals): The totals of the current session.
 
     Returns:
-        float: The average value or 0 if the list is empty.
+        None
     """
-    return sum(values) / len(values) if values else 0
+    message.remove_field(RecordTemperatureField.ID)
+    totals.cadence += message.cadence or 0
+    totals.power += message.power or 0
+    totals.heart_rate += message.heart_rate or 0
+    totals.count += 1
 
 
-def append_value(values: List[int], message: object, field_name: str) -> None:
+def process_session_message(message: object, totals: SessionTotals) -> None:
     """
-    Appends a value to the 'values' list based on a field from 'message'.
+    Fill in missing averages of a session message from the running totals
+    and reset them for the next session.
 
     Args:
-        values (List[int]): The list to append the value to.
-        message (object): The object that holds the field value.
-        field_name (str): The name of the field to retrieve from the message.
+        message (SessionMessage): The session message to process.
+        totals (SessionTotals): The totals of the session being closed.
 
     Returns:
         None
     """
-    value=getattr(message, field_name, None)
-    values.append(value if value else 0)
+    if not message.avg_cadence:
+        message.avg_cadence = totals.average(totals.cadence)
+    if not message.avg_power:
+        message.avg_power = totals.average(totals.power)
+    if not message.avg_heart_rate:
+        message.avg_heart_rate = totals.average(totals.heart_rate)
+    totals.reset()
 
 
-def reset_values() -> tuple[List[int], List[int], List[int]]:
+def needs_cleanup(fit_file: object) -> bool:
     """
-    Resets and returns three empty lists for cadence, power 
-    and heart rate values.
+    Check whether a FIT file has anything for cleanup_fit_file to fix:
+    lap messages, temperature fields or sessions without averages.
+
+    Args:
+        fit_file (FitFile): The parsed FIT file.
 
     Returns:
-        tuple: A tuple containing three empty lists 
-        (cadence, power, and heart rate).
+        bool: True as soon as something to clean up is found.
     """
-    return  [], [], []
+    for record in fit_file.records:
+        message = record.message
+        message_type = type(message)
+        if message_type is LapMessage:
+            return True
+        if message_type is RecordMessage:
+            field = message.get_field(RecordTemperatureField.ID)
+            if field and field.is_valid():
+                return True
+        elif message_type is SessionMessage:
+            if not (message.avg_cadence and message.avg_power
+                    and message.avg_heart_rate):
+                return True
+    return False
 
 
 def cleanup_fit_file(fit_file_path: Path, new_file_path: Path) -> None:
@@ -341,43 +416,62 @@ def cleanup_fit_file(fit_file_path: Path, new_file_path: Path) -> None:
     Returns:
         None
     """
-    builder = FitFileBuilder()
     fit_file = FitFile.from_file(str(fit_file_path))
-    cadence_values, power_values, heart_rate_values = reset_values()
+    if not needs_cleanup(fit_file):
+        shutil.copy2(fit_file_path, new_file_path)
+        logger.info(f"Nothing to clean up, copied file as "
+                    f"{new_file_path.name}")
+        return
+
+    builder = FitFileBuilder()
+    handlers = {
+        RecordMessage: process_record_message,
+        SessionMessage: process_session_message,
+    }
+    totals = SessionTotals()
+    # Bound once so the loop avoids repeated attribute lookups.
+    get_handler = handlers.get
+    add_message = builder.add
+    lap_message = LapMessage
 
     for record in fit_file.records:
         message = record.message
-        if isinstance(message, (LapMessage)):
+        message_type = type(message)
+        if message_type is lap_message:
             continue
-        if isinstance(message, RecordMessage):
-            message.remove_field(RecordTemperatureField.ID)
-            append_value(cadence_values, message, "cadence")
-            append_value(power_values, message, "power")
-            append_value(heart_rate_values, message, "heart_rate")
-        if isinstance(message, SessionMessage):
-            if not message.avg_cadence:
-                message.avg_cadence = calculate_avg(cadence_values)
-            if not message.avg_power:
-                message.avg_power = calculate_avg(power_values)
-            if not message.avg_heart_rate:
-                message.avg_heart_rate = calculate_avg(heart_rate_values)
-            cadence_values, power_values, heart_rate_values = reset_values()
-        builder.add(message)
+        handler = get_handler(message_type)
+        if handler is not None:
+            handler(message, totals)
+        add_message(message)
+    # The builder holds its own records; release the parsed file first.
+    del fit_file
     builder.build().to_file(str(new_file_path))
     logger.info(f"Cleaned-up file saved as {SCRIPT_DIR}/{new_file_path.name}")
 
 
+def fit_file_version(file_name: str) -> tuple[int, ...]:
+    """
+    Returns the version numbers of a MyNewActivity-<version>.fit name
+    as a tuple of ints, e.g. (3, 2, 1) for MyNewActivity-3.2.1.fit.
+    """
+    version = file_name[:-len(".fit")].rsplit("-", 1)[-1]
+    return tuple(int(digits) for digits in VERSION_DIGITS.findall(version))
+
+
 def get_most_recent_fit_file(fitfile_location: Path) -> Path:
     """
     Returns the most recent .fit file based 
     on versioning in the filename.
     """
-    fit_files = fitfile_location.glob("MyNewActivity-*.fit")
-    fit_files = sorted(fit_files, key=lambda f: 
-                       tuple(map(int, re.findall(r'(\d+)',
-                                                 f.stem.split('-')[-1]))),
-                       reverse=True)
-    return fit_files[0] if fit_files else Path()
+    with os.scandir(fitfile_location) as entries:
+        most_recent = max(
+            (entry for entry in entries
+             if entry.name.startswith("MyNewActivity-")
+             and entry.name.endswith(".fit")),
+            key=lambda entry: fit_file_version(entry.name),
+            default=None,
+        )
+    return Path(most_recent.path) if most_recent else Path()
 
 
 def generate_new_filename(fit_file: Path) -> str:
@@ -460,8 +554,10 @@ def main():
     Returns:
         None
     """
+    ensure_packages()
+    import_dependencies()
     authenticate_to_garmin()
-    new_file_path = cleanup_and_save_fit_file(FITFILE_LOCATION)
+    new_file_path = cleanup_and_save_fit_file(get_fitfile_location())
     if new_file_path:
         upload_fit_file_to_garmin(new_file_path)
 
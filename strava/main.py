@@ -5,17 +5,35 @@ Handles authentication, session management, and tracks downloaded activities in
 """
 
 import json
+import logging
 import os
+import shutil
 import sqlite3
+import sys
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterable, List, Optional, Set, Tuple
 from urllib.parse import parse_qs, urlparse
 
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from requests import Session
+from requests.adapters import HTTPAdapter
+
+
+# Concurrent activity downloads; also the size of the HTTP connection pool.
+MAX_DOWNLOAD_WORKERS = 8
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(console_handler)
 
 
 class StravaSettings(BaseSettings):
@@ -45,10 +63,11 @@ class TokenData(BaseModel):
         """Create TokenData instance from JSON response."""
         if isinstance(data.get("expires_at"), int):
             data["expires_at"] = datetime.fromtimestamp(data["expires_at"])
-        return cls(**data)
+        return cls.model_validate(data)
 
 
-class ActivityDetails(BaseModel):
+@dataclass(slots=True)
+class ActivityDetails:
     """Model representing Strava activity details."""
     
     id: int
@@ -56,12 +75,31 @@ class ActivityDetails(BaseModel):
     start_date: datetime
     type: str
 
+    @classmethod
+    def from_api(cls, data: dict):
+        """Create ActivityDetails instance from a Strava API activity."""
+        return cls(
+            id=data["id"],
+            name=data["name"],
+            start_date=datetime.fromisoformat(
+                data["start_date"].replace("Z", "+00:00")
+            ),
+            type=data["type"],
+        )
+
 
 class ActivityDatabase:
     """Database handler for tracking downloaded activities."""
     
+    # Host parameter limit of SQLite builds older than 3.32.
+    MAX_VARIABLES = 999
+
     def __init__(self, db_file: str):
         self.conn = sqlite3.connect(db_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-16384")
         self._create_table()
 
     def _create_table(self):
@@ -69,48 +107,78 @@ class ActivityDatabase:
         query = """
         CREATE TABLE IF NOT EXISTS downloaded_activities (
             activity_id INTEGER PRIMARY KEY,
-            downloaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            downloaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            start_date INTEGER
         )
         """
         self.conn.execute(query)
+        columns = {
+            row[1] for row in
+            self.conn.execute("PRAGMA table_info(downloaded_activities)")
+        }
+        if "start_date" not in columns:
+            self.conn.execute(
+                "ALTER TABLE downloaded_activities ADD COLUMN start_date INTEGER"
+            )
         self.conn.commit()
 
-    def is_downloaded(self, activity_id: int) -> bool:
-        """Check if activity is already downloaded."""
+    def downloaded_among(self, activity_ids: List[int]) -> Set[int]:
+        """Return which of the given activities are already downloaded."""
+        known = set()
+        for start in range(0, len(activity_ids), self.MAX_VARIABLES):
+            chunk = activity_ids[start:start + self.MAX_VARIABLES]
+            placeholders = ", ".join("?" * len(chunk))
+            cursor = self.conn.execute(
+                "SELECT activity_id FROM downloaded_activities "
+                f"WHERE activity_id IN ({placeholders})",
+                chunk
+            )
+            known.update(row[0] for row in cursor)
+        return known
+
+    def latest_start_date(self) -> Optional[int]:
+        """Return the start epoch of the newest downloaded activity."""
         cursor = self.conn.execute(
-            "SELECT 1 FROM downloaded_activities WHERE activity_id = ?",
-            (activity_id,)
+            "SELECT MAX(start_date) FROM downloaded_activities"
         )
-        return bool(cursor.fetchone())
+        return cursor.fetchone()[0]
 
-    def mark_downloaded(self, activity_id: int):
-        """Mark an activity as downloaded."""
-        self.conn.execute(
-            "INSERT OR IGNORE INTO downloaded_activities (activity_id) VALUES (?)",
-            (activity_id,)
-        )
-        self.conn.commit()
+    def mark_downloaded_many(
+        self, activities: Iterable[Tuple[int, Optional[int]]]
+    ):
+        """
+        Mark several (activity_id, start_date) pairs as downloaded
+        in a single transaction.
+        """
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO downloaded_activities "
+                "(activity_id, start_date) VALUES (?, ?)",
+                activities
+            )
 
     def close(self):
-        """Close database connection."""
+        """Refresh planner statistics and close database connection."""
+        if self.conn is None:
+            return
+        self.conn.execute("PRAGMA optimize")
         self.conn.close()
+        self.conn = None
 
 
 class StravaAuth:
     """Handles Strava OAuth2 authentication and token management."""
     
-    def __init__(self, settings: StravaSettings):
+    def __init__(self, settings: StravaSettings, session: Session):
         self.settings = settings
         self.token_data: Optional[TokenData] = None
-        self.session = Session()
-        self._initialize_session()
+        self.session = session
+        self._load_tokens()
 
-    def _initialize_session(self):
-        """Initialize requests session with valid token."""
-        if self._load_tokens() and self._is_token_valid():
-            self.session.headers.update({
-                "Authorization": f"Bearer {self.token_data.access_token}"
-            })
+    @property
+    def headers(self) -> dict:
+        """Authorization header for Strava API requests."""
+        return {"Authorization": f"Bearer {self.token_data.access_token}"}
 
     def _is_token_valid(self) -> bool:
         """Check if access token is still valid."""
@@ -132,7 +200,7 @@ class StravaAuth:
                     self.refresh_token()
                 except requests.HTTPError as e:
                     if e.response.status_code == 400:
-                        print("Refresh token expired, re-authenticating...")
+                        logger.warning("Refresh token expired, re-authenticating...")
                         self._perform_oauth_flow()
                     else:
                         raise
@@ -148,7 +216,7 @@ class StravaAuth:
             "redirect_uri=http://localhost/exchange_token&"
             "scope=activity:read_all"
         )
-        print(f"🔗 Authorize here: {auth_url}")
+        logger.info(f"🔗 Authorize here: {auth_url}")
         redirect_url = input("🔄 Paste callback URL: ")
         self._fetch_token(redirect_url)
 
@@ -158,7 +226,7 @@ class StravaAuth:
         if not code:
             raise ValueError("Authorization code missing")
 
-        response = requests.post(
+        response = self.session.post(
             self.settings.token_url,
             data={
                 "client_id": self.settings.client_id,
@@ -171,11 +239,12 @@ class StravaAuth:
         self._save_tokens(response.json())
 
     def _save_tokens(self, token_data: dict) -> None:
-        """Save tokens to file and update session."""
-        with open(self.settings.token_file, "w") as f:
-            json.dump(token_data, f)
+        """Save tokens to file and update token data."""
+        # Write a sibling file first so a crash never leaves a torn token file.
+        tmp_file = f"{self.settings.token_file}.tmp"
+        Path(tmp_file).write_text(json.dumps(token_data))
+        os.replace(tmp_file, self.settings.token_file)
         self.token_data = TokenData.from_json(token_data)
-        self._initialize_session()
 
     def _load_tokens(self) -> bool:
         """Load tokens from storage file."""
@@ -191,7 +260,7 @@ class StravaAuth:
         if not self.token_data or not self.token_data.refresh_token:
             raise ValueError("No refresh token available")
 
-        response = requests.post(
+        response = self.session.post(
             self.settings.token_url,
             data={
                 "client_id": self.settings.client_id,
@@ -210,6 +279,9 @@ class CookieManager:
     def __init__(self, cookie_file: str):
         self.cookie_file = cookie_file
         self.session = Session()
+        self.session.mount(
+            "https://", HTTPAdapter(pool_maxsize=MAX_DOWNLOAD_WORKERS)
+        )
 
     def load_cookies(self) -> None:
         """Load cookies from storage file."""
@@ -238,75 +310,174 @@ class ActivityDownloader:
         "Sec-Fetch-User": "?1",
         "Upgrade-Insecure-Requests": "1"
     }
+    CHUNK_SIZE = 1 << 20
+    # Minimum spacing in seconds between export requests of all workers.
+    MIN_REQUEST_INTERVAL = 0.5
+    RATE_LIMIT_RETRIES = 3
+    RATE_LIMIT_BACKOFF = 15
 
     def __init__(self, session: Session, database: ActivityDatabase):
         self.session = session
         self.db = database
+        self.known_ids: Set[int] = set()
+        self._request_lock = threading.Lock()
+        self._next_request_at = 0.0
 
     def download_activity(self, activity_id: int) -> bool:
         """Download activity file with retry logic."""
-        try:
-            return self._download_attempt(activity_id)
-        except requests.HTTPError as e:
-            if e.response.status_code == 401:
-                print("Token expired during download, refreshing...")
-                self.session.auth.refresh_token()
+        for attempt in range(self.RATE_LIMIT_RETRIES + 1):
+            try:
                 return self._download_attempt(activity_id)
-            raise
+            except requests.HTTPError as e:
+                status_code = e.response.status_code
+                if status_code == 429 and attempt < self.RATE_LIMIT_RETRIES:
+                    delay = self._retry_delay(e.response, attempt)
+                    logger.warning(f"Rate limited by Strava, pausing "
+                                   f"downloads for {delay:.0f}s...")
+                    self._delay_requests(delay)
+                    continue
+                if status_code in (401, 403):
+                    raise requests.HTTPError(
+                        "Strava web session expired, refresh cookie.json",
+                        response=e.response
+                    ) from e
+                raise
+
+    def _retry_delay(
+        self, response: requests.Response, attempt: int
+    ) -> float:
+        """Return the Retry-After delay, or an exponential backoff."""
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return self.RATE_LIMIT_BACKOFF * 2 ** attempt
+
+    def _delay_requests(self, delay: float) -> None:
+        """Hold back the next request of every worker by delay seconds."""
+        with self._request_lock:
+            self._next_request_at = max(
+                self._next_request_at, time.monotonic() + delay
+            )
+
+    def _wait_for_request_slot(self) -> None:
+        """Space requests MIN_REQUEST_INTERVAL apart across all workers."""
+        with self._request_lock:
+            now = time.monotonic()
+            request_at = max(now, self._next_request_at)
+            self._next_request_at = request_at + self.MIN_REQUEST_INTERVAL
+        if request_at > now:
+            time.sleep(request_at - now)
+
+    def download_many(self, activity_ids: List[int]) -> List[int]:
+        """
+        Download activities concurrently and return the IDs fetched.
+
+        A failed download is logged and does not stop the others.
+        """
+        downloaded_ids = []
+        with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+            futures = {
+                executor.submit(self.download_activity, activity_id):
+                    activity_id
+                for activity_id in activity_ids
+            }
+            for future in as_completed(futures):
+                activity_id = futures[future]
+                try:
+                    if future.result():
+                        downloaded_ids.append(activity_id)
+                except Exception as e:
+                    logger.error(
+                        f"❌ Failed to download activity {activity_id}: {e}"
+                    )
+        return downloaded_ids
 
     def _download_attempt(self, activity_id: int) -> bool:
         """Perform single download attempt for an activity."""
-        if self.db.is_downloaded(activity_id):
+        if activity_id in self.known_ids:
             return False
 
-        response = self.session.get(
+        self._wait_for_request_slot()
+        with self.session.get(
             f"https://www.strava.com/activities/{activity_id}/export_original",
             stream=True,
             headers=self.CHROME_HEADERS
-        )
-        response.raise_for_status()
+        ) as response:
+            response.raise_for_status()
 
-        filename = f"activity_{activity_id}_original.fit"
-        with open(filename, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+            filename = f"activity_{activity_id}_original.fit"
+            response.raw.decode_content = True
+            with open(filename, "wb") as f:
+                shutil.copyfileobj(response.raw, f, length=self.CHUNK_SIZE)
 
-        self.db.mark_downloaded(activity_id)
-        print(f"✅ Downloaded {filename}")
+        self.known_ids.add(activity_id)
+        logger.info(f"✅ Downloaded {filename}")
         return True
 
 
 class StravaClient:
     """Main client for interacting with Strava API."""
     
-    def __init__(self, auth: StravaAuth, downloader: ActivityDownloader):
+    PER_PAGE = 200
+
+    def __init__(
+        self,
+        auth: StravaAuth,
+        downloader: ActivityDownloader,
+        session: Session
+    ):
         self.auth = auth
         self.downloader = downloader
+        self.session = session
+
+    def get_filtered_activities(
+        self, after: Optional[int] = None
+    ) -> List[ActivityDetails]:
+        """
+        Retrieve filtered list of activities.
 
-    def get_filtered_activities(self) -> List[ActivityDetails]:
-        """Retrieve filtered list of activities."""
+        Without ``after`` only the most recent page is fetched. With it,
+        Strava returns just the activities started after that epoch and
+        every page of them is fetched.
+        """
         self.auth.authenticate()
 
+        params = {"per_page": self.PER_PAGE}
+        if after is not None:
+            params["after"] = after
+
+        activities = []
+        page = 1
+        while True:
+            batch = self._fetch_activities({**params, "page": page})
+            activities.extend(
+                ActivityDetails.from_api(activity)
+                for activity in batch
+                if activity.get("type") == "VirtualRide"
+                and "MyWhoosh" in activity.get("name", "")
+            )
+            if after is None or len(batch) < self.PER_PAGE:
+                return activities
+            page += 1
+
+    def _fetch_activities(self, params: dict) -> List[dict]:
+        """Fetch one page of raw activities."""
         try:
-            response = self.auth.session.get(
+            response = self.session.get(
                 self.auth.settings.activities_url,
-                params={"per_page": 100}
+                params=params,
+                headers=self.auth.headers
             )
             response.raise_for_status()
 
         except requests.HTTPError as e:
             if e.response.status_code == 401:
-                print("Token expired during request, refreshing...")
+                logger.warning("Token expired during request, refreshing...")
                 self.auth.refresh_token()
-                return self.get_filtered_activities()
+                return self._fetch_activities(params)
             raise
 
-        return [
-            ActivityDetails(**activity)
-            for activity in response.json()
-            if activity.get("type") == "VirtualRide"
-            and "MyWhoosh" in activity.get("name", "")
-        ]
+        return response.json()
 
 
 class StravaClientBuilder:
@@ -314,8 +485,8 @@ class StravaClientBuilder:
     
     def __init__(self):
         self.settings = StravaSettings()
-        self.auth = StravaAuth(self.settings)
         self.cookie_manager = CookieManager(self.settings.cookie_file)
+        self.auth = StravaAuth(self.settings, self.cookie_manager.session)
         self.database = ActivityDatabase(self.settings.database_file)
 
     def with_auth(self) -> "StravaClientBuilder":
@@ -331,13 +502,16 @@ class StravaClientBuilder:
     def build(self) -> StravaClient:
         """Build configured StravaClient instance."""
         downloader = ActivityDownloader(
-            self.auth.session,
+            self.cookie_manager.session,
             self.database
         )
-        return StravaClient(self.auth, downloader)
+        return StravaClient(
+            self.auth, downloader, self.cookie_manager.session
+        )
 
     def __del__(self):
         """Cleanup resources on deletion."""
+        self.cookie_manager.session.close()
         self.database.close()
 
 
@@ -347,33 +521,55 @@ if __name__ == "__main__":
         client_builder = StravaClientBuilder()
         client = client_builder.with_auth().with_cookies().build()
 
-        all_activities = client.get_filtered_activities()
+        all_activities = client.get_filtered_activities(
+            after=client.downloader.db.latest_start_date()
+        )
+        previously_downloaded = client.downloader.db.downloaded_among(
+            [a.id for a in all_activities]
+        )
+        client.downloader.known_ids.update(previously_downloaded)
         new_activities = [
-            a for a in all_activities
-            if not client.downloader.db.is_downloaded(a.id)
+            a for a in all_activities if a.id not in previously_downloaded
         ]
 
         if not new_activities:
-            print("No new activities found")
+            logger.info("No new activities found")
             exit()
 
-        print("\n🏆 New Virtual Rides with 'MyWhoosh' in name:")
+        logger.info("\n🏆 New Virtual Rides with 'MyWhoosh' in name:")
         for activity in new_activities:
             date_str = activity.start_date.strftime("%Y-%m-%d %H:%M")
-            print(f"📅 {date_str} - {activity.name} (ID: {activity.id})")
+            logger.info(f"📅 {date_str} - {activity.name} (ID: {activity.id})")
 
-        new_downloads = 0
-        for activity in new_activities:
-            if client.downloader.download_activity(activity.id):
-                new_downloads += 1
+        downloaded_ids = client.downloader.download_many(
+            [activity.id for activity in new_activities]
+        )
+        downloaded = set(downloaded_ids)
+        # Downloads newer than a failed one are stored without a start date
+        # so the next run's "after" filter still returns the failed activity.
+        oldest_failure = min(
+            (a.start_date for a in new_activities if a.id not in downloaded),
+            default=None
+        )
+        client.downloader.db.mark_downloaded_many(
+            (
+                activity.id,
+                int(activity.start_date.timestamp())
+                if oldest_failure is None or activity.start_date < oldest_failure
+                else None
+            )
+            for activity in new_activities
+            if activity.id in downloaded
+        )
+        new_downloads = len(downloaded_ids)
 
-        print("\nDownload summary:")
-        print(f"• New activities downloaded: {new_downloads}")
-        print(f"• Already existed: {len(all_activities) - len(new_activities)}")
-        print(f"• Total processed: {len(all_activities)}")
+        logger.info("\nDownload summary:")
+        logger.info(f"• New activities downloaded: {new_downloads}")
+        logger.info(f"• Already existed: {len(all_activities) - len(new_activities)}")
+        logger.info(f"• Total processed: {len(all_activities)}")
 
     except Exception as e:
-        print(f"❌ Error: {str(e)}")
+        logger.error(f"❌ Error: {str(e)}")
     finally:
         if client_builder:
             client_builder.database.close()